@@ -2,12 +2,21 @@
 """
 
 import os
+import sys
+import marshal
+import random
+import shutil
 import subprocess
+import timeit
 import pytest
 from pytest import raises
 
 from translate_to_legacy import (BaseTranslator, LegacyPythonTranslator,
-                                 Token, CancelTranslation)
+                                 Token, CancelTranslation, TranslationCache,
+                                 RegexTokenizer, StdlibTokenizer,
+                                 compare_tokenizers, merge_manifests,
+                                 IncrementalTranslator, TokenCache,
+                                 ScopeTree, translate_dir_multi)
 
 
 def test_token1():
@@ -137,6 +146,47 @@ def test_tokenization():
         assert all([token.type == 'identifier' for token in tokens])
 
 
+def test_tokenizers():
+    
+    class StdlibTranslator(LegacyPythonTranslator):
+        TOKENIZER = StdlibTokenizer
+    
+    # Same results for plain code
+    code = """# comment ''
+    import os
+    
+    class Foo(Bar):
+        '''docstring'''
+        def spam(self, a, b=3, *args):
+            x = "str" + 'str' + b"bytes" + r'raw' + '''
+            multi ''' + \\
+                u"x"  # comment
+            return super().spam(range(10), str(x), 0x1f)
+    """
+    tokens1 = RegexTokenizer.tokenize(code)
+    tokens2 = StdlibTokenizer.tokenize(code)
+    assert [(t.type, t.text) for t in tokens1] == [(t.type, t.text)
+                                                   for t in tokens2]
+    assert (LegacyPythonTranslator(code).translate() ==
+            StdlibTranslator(code).translate())
+    
+    # The stdlib tokenizer knows about string prefixes and f-strings
+    code = "x = rb'x' + f'{a} {b:{c}}' + Rb'y'\ny = 1.5\n"
+    tokens = StdlibTranslator(code).tokens
+    assert [t.text for t in tokens] == ['x', "rb'x'", "f'{a} {b:{c}}'",
+                                        "Rb'y'", 'y', '1.5']
+    assert [t.type for t in tokens[1:4]] == ['string'] * 3
+    assert tokens[1].next_token is tokens[2]
+    
+    # Compare
+    sources = ['foo = bar', code, 'def (']
+    results = compare_tokenizers(sources, repeat=1)
+    assert results['regex']['mismatches'] == []
+    assert results['stdlib']['mismatches'] == [1, 2]
+    assert results['regex']['time'] > 0
+    assert results['stdlib']['time'] > 0
+
+
 def test_cancel():
     
     code = """
@@ -147,6 +197,482 @@ def test_cancel():
     raises(CancelTranslation, LegacyPythonTranslator(code).translate)
 
 
+def test_translation_cache():
+    
+    cache = TranslationCache(maxsize=2)
+    code1, code2, code3 = 'range(3)', 'str(x)', 'chr(y)'
+    
+    # Misses and hits give the same result as a normal translation
+    for i in range(2):
+        for code in (code1, code2):
+            new_code = cache.translate(LegacyPythonTranslator, code)
+            assert new_code == LegacyPythonTranslator(code).translate()
+    assert cache.stats['misses'] == 2
+    assert cache.stats['hits'] == 2
+    assert cache.stats['size'] == 2
+    
+    # Cache key includes the translator class
+    assert cache.translate(BaseTranslator, code1) == code1
+    assert cache.stats['misses'] == 3
+    assert cache.stats['evictions'] == 1
+    
+    # Least recently used is evicted
+    cache.translate(LegacyPythonTranslator, code2)
+    assert cache.stats['hits'] == 3
+    cache.translate(LegacyPythonTranslator, code3)
+    cache.translate(LegacyPythonTranslator, code2)
+    assert cache.stats['hits'] == 4
+    cache.translate(BaseTranslator, code1)
+    assert cache.stats['misses'] == 5
+    
+    # Cancellations are cached
+    code = 'from __future__ import print_function\n'
+    for i in range(2):
+        raises(CancelTranslation, cache.translate, LegacyPythonTranslator, code)
+    assert cache.stats['hits'] == 5
+    
+    cache.clear()
+    assert cache.stats == dict(hits=0, misses=0, evictions=0, size=0,
+                               maxsize=2)
+
+
+def test_translate_dir_shards(tmpdir):
+    
+    # Create a directory with some files
+    dirname = str(tmpdir.mkdir('src'))
+    for i in range(20):
+        subdir = os.path.join(dirname, 'sub%i' % (i % 3))
+        if not os.path.isdir(subdir):
+            os.mkdir(subdir)
+        with open(os.path.join(subdir, 'f%i.py' % i), 'wb') as f:
+            f.write(b'x = range(%i)\n' % i)
+    with open(os.path.join(dirname, 'cancel.py'), 'wb') as f:
+        f.write(b'from __future__ import print_function\n')
+    
+    # Run shards in separate processes
+    script = os.path.join(os.path.dirname(__file__), 'translate_to_legacy.py')
+    manifests = []
+    for i in range(3):
+        manifests.append(os.path.join(str(tmpdir), 'shard%i.json' % i))
+        subprocess.check_call([sys.executable, script, dirname,
+                               '--skip', 'f0.py',
+                               '--shard-index', str(i), '--shard-count', '3',
+                               '--manifest', manifests[i]])
+    
+    # All files are covered
+    outcomes = merge_manifests(manifests, dirname)
+    assert len(outcomes) == 21
+    assert outcomes['cancel.py'] == 'cancelled'
+    assert outcomes['sub0/f0.py'] == 'skipped'
+    assert outcomes['sub1/f1.py'] == 'translated'
+    with open(os.path.join(dirname, 'sub1', 'f1.py'), 'rb') as f:
+        assert b'xrange(1)' in f.read()
+    with open(os.path.join(dirname, 'sub0', 'f0.py'), 'rb') as f:
+        assert b'xrange' not in f.read()
+    
+    # Shards are disjoint and not all empty
+    sizes = [len(LegacyPythonTranslator.translate_dir(dirname, (), i, 3))
+             for i in range(3)]
+    assert sum(sizes) == 21 and 0 not in sizes
+    
+    # Incomplete coverage is detected
+    raises(ValueError, merge_manifests, manifests[:2], dirname)
+    raises(ValueError, merge_manifests, manifests[:1] * 3, dirname)
+    with open(os.path.join(dirname, 'new.py'), 'wb') as f:
+        f.write(b'pass\n')
+    raises(ValueError, merge_manifests, manifests, dirname)
+    assert subprocess.call([sys.executable, script, dirname,
+                            '--merge'] + manifests) == 1
+    
+    raises(ValueError, LegacyPythonTranslator.translate_dir, dirname, (), 3, 3)
+
+
+def test_translate_dir_progress(tmpdir, capsys, monkeypatch):
+    
+    dirname = str(tmpdir)
+    def make_files():
+        for fname, code in [('a.py', b'x = range(3)\ny = str(x)\n'),
+                            ('b.py', b'from __future__ import division\n'),
+                            ('c.py', b'pass\n')]:
+            with open(os.path.join(dirname, fname), 'wb') as f:
+                f.write(code)
+    
+    # Default prints a single summary
+    make_files()
+    outcomes = LegacyPythonTranslator.translate_dir(dirname, ['c.py'])
+    lines = capsys.readouterr().out.strip().splitlines()
+    assert len(lines) == 1
+    assert '1 translated, 1 cancelled, 1 skipped' in lines[0]
+    assert outcomes == {'a.py': 'translated', 'b.py': 'cancelled',
+                        'c.py': 'skipped'}
+    
+    # Quiet, does not measure anything
+    def fail():
+        raise RuntimeError('should not be called')
+    make_files()
+    monkeypatch.setattr(timeit, 'default_timer', fail)
+    LegacyPythonTranslator.translate_dir(dirname, ['c.py'], progress=False)
+    assert capsys.readouterr().out == ''
+    make_files()
+    results = list(LegacyPythonTranslator.iter_translate_dir(dirname,
+                                                             stats=False))
+    assert [(r.duration, r.fixes) for r in results] == [(0.0, 0)] * 3
+    monkeypatch.undo()
+    
+    # Callback with result records
+    make_files()
+    results = []
+    LegacyPythonTranslator.translate_dir(dirname, progress=results.append)
+    assert capsys.readouterr().out == ''
+    results = dict((r.path, r) for r in results)
+    assert results['a.py'].outcome == 'translated'
+    assert results['a.py'].fixes == 3  # xrange, unicode, future import
+    assert results['a.py'].bytes_out > results['a.py'].bytes_in > 0
+    assert results['a.py'].duration > 0
+    assert results['b.py'].outcome == 'cancelled'
+    assert results['b.py'].bytes_out == 0
+    assert str(results['c.py']) == "translated: 'c.py'"
+    
+    # Iterator
+    results = list(BaseTranslator.iter_translate_dir(dirname, ['b.py']))
+    assert sorted(r.path for r in results) == ['a.py', 'b.py', 'c.py']
+
+
+def make_counting_tokenizer():
+    """ Get a new tokenizer class that counts how often it tokenizes.
+    """
+    class CountingTokenizer(RegexTokenizer):
+        name = 'counting'
+        count = 0
+        @classmethod
+        def tokenize(cls, text):
+            cls.count += 1
+            return RegexTokenizer.tokenize(text)
+    return CountingTokenizer
+
+
+def write_files(dirname, codes):
+    """ Write a dict of relative paths to code to the given directory.
+    """
+    for relpath, code in codes.items():
+        filename = os.path.join(dirname, *relpath.split('/'))
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(code.encode('utf-8'))
+
+
+def test_token_cache(tmpdir, monkeypatch):
+    
+    CountingTokenizer = make_counting_tokenizer()
+    
+    class MyTranslator(LegacyPythonTranslator):
+        TOKENIZER = CountingTokenizer
+    
+    class MyTranslator2(MyTranslator):
+        def fix_foo(self, token):
+            if token.text == 'foo':
+                token.fix = 'bar'
+    
+    codes = ['class Foo:\n    def foo(self):\n        super().foo()\n',
+             '# comment\n"""doc"""\nfoo = range(3)  # x\n']
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    dirname = os.path.join(str(tmpdir), 'src')
+    
+    def make_files():
+        write_files(dirname, dict(('f%i.py' % i, code)
+                                  for i, code in enumerate(codes)))
+    
+    def read_files():
+        return [open(os.path.join(dirname, 'f%i.py' % i), 'rb').read()
+                for i in range(len(codes))]
+    
+    # First run fills the cache
+    make_files()
+    MyTranslator.translate_dir(dirname, cache_dir=cache_dir, progress=False)
+    assert CountingTokenizer.count == 2
+    assert len(os.listdir(cache_dir)) == 2
+    
+    # Runs with other fixers do not tokenize, and give the same result
+    for cls in (MyTranslator2, MyTranslator):
+        make_files()
+        cls.translate_dir(dirname, progress=False)
+        expected = read_files()
+        CountingTokenizer.count = 0
+        make_files()
+        cls.translate_dir(dirname, cache_dir=cache_dir, progress=False)
+        assert CountingTokenizer.count == 0
+        assert read_files() == expected
+        assert (b'def bar(self)' in expected[0]) == (cls is MyTranslator2)
+    assert b'super(Foo, self).foo()' in expected[0]
+    
+    # Changed tokenizer version does not use cache
+    CountingTokenizer.version = 2
+    make_files()
+    MyTranslator.translate_dir(dirname, cache_dir=cache_dir, progress=False)
+    assert CountingTokenizer.count == 2
+    
+    # A corrupt cache file is a miss
+    cache = TokenCache(cache_dir)
+    for fname in os.listdir(cache_dir):
+        with open(os.path.join(cache_dir, fname), 'wb') as f:
+            f.write(b'xx')
+    assert cache.get(codes[0], CountingTokenizer) is None
+    tokens = cache.tokenize(codes[0], CountingTokenizer)
+    tokens2 = cache.get(codes[0], CountingTokenizer)
+    assert [(t.type, t.start, t.end) for t in tokens] == [
+        (t.type, t.start, t.end) for t in tokens2]
+    assert not [fname for fname in os.listdir(cache_dir)
+                if fname.endswith('.tmp')]
+    
+    # Entries with bad content are a miss too
+    filename = cache._filename(codes[0], CountingTokenizer)
+    for entry in [(b'\x09', [0], [1]), (b'\x00', ['0'], [1]),
+                  (b'\x00\x00', [0], [1]), (b'\x00', 0, 1), None]:
+        with open(filename, 'wb') as f:
+            f.write(marshal.dumps(entry))
+        assert cache.get(codes[0], CountingTokenizer) is None
+    
+    # A cache hit does not tokenize, and does not build the scope tree
+    # if no fixer needs it
+    for code in codes:
+        cache.tokenize(code, CountingTokenizer)
+    builds = []
+    build = ScopeTree._build
+    monkeypatch.setattr(ScopeTree, '_build',
+                        lambda self: builds.append(1) or build(self))
+    CountingTokenizer.count = 0
+    make_files()
+    MyTranslator.translate_dir(dirname, cache_dir=cache_dir, progress=False)
+    assert CountingTokenizer.count == 0
+    assert len(builds) == 1  # for super() in codes[0], not for codes[1]
+    
+    # Another process may create the cache dir at the same time
+    new_dir = os.path.join(str(tmpdir), 'cache2')
+    isdir = os.path.isdir
+    def isdir_racing(path):
+        if path == new_dir and not isdir(path):
+            os.mkdir(path)
+            return False
+        return isdir(path)
+    monkeypatch.setattr(os.path, 'isdir', isdir_racing)
+    TokenCache(new_dir)
+    assert isdir(new_dir)
+    monkeypatch.undo()
+    
+    # A failing put is a miss, and does not abort translate_dir
+    class RemovingTokenizer(RegexTokenizer):
+        name = 'removing'
+        @classmethod
+        def tokenize(cls, text):
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            return RegexTokenizer.tokenize(text)
+    
+    class MyTranslator3(LegacyPythonTranslator):
+        TOKENIZER = RemovingTokenizer
+    
+    make_files()
+    MyTranslator3.translate_dir(dirname, cache_dir=cache_dir, progress=False)
+    assert not os.path.exists(cache_dir)
+    assert b'super(Foo, self).foo()' in read_files()[0]
+    assert cache.get(codes[0], RemovingTokenizer) is None
+
+
+def test_translate_dir_multi(tmpdir):
+    
+    CountingTokenizer = make_counting_tokenizer()
+    
+    class Translator1(LegacyPythonTranslator):
+        TOKENIZER = CountingTokenizer
+        def fix_hide_str(self, token):
+            if token.text == 'str':
+                token.type = 'custom'
+    
+    class Translator2(LegacyPythonTranslator):
+        TOKENIZER = CountingTokenizer
+        RENAMES = LegacyPythonTranslator.RENAMES + (('foo', 'bar', None,
+                                                     None), )
+        def fix_make_legacy_slow(self, token):
+            if token.type == 'keyword' and token.text == 'return':
+                t = Token(token.total_text, 'custom', token.start, token.start)
+                t.fix = 'sleep(); '
+                return t
+    
+    codes = {'a.py': 'class Foo:\n    def foo(self):\n        '
+                     'return super().foo()\n',
+             'sub/b.py': 'import queue\nfoo = str(3).encode()\n',
+             'c.py': 'from __future__ import division\n',
+             'd.py': 'foo = range(3)\n'}
+    dirname = os.path.join(str(tmpdir), 'src')
+    write_files(dirname, codes)
+    
+    dest1 = os.path.join(str(tmpdir), 'dest1')
+    dest2 = os.path.join(str(tmpdir), 'dest2')
+    results = []
+    all_outcomes = translate_dir_multi(dirname, [(Translator1, dest1),
+                                                 (Translator2, dest2)],
+                                       skip=['d.py'], progress=results.append)
+    
+    # Each (not skipped) file is tokenized once
+    assert CountingTokenizer.count == 3
+    assert len(results) == 8
+    assert set(r.translator for r in results) == set(['Translator1',
+                                                      'Translator2'])
+    
+    # Results are the same as translating each separately
+    for cls, dest in [(Translator1, dest1), (Translator2, dest2)]:
+        outcomes = all_outcomes[cls]
+        assert outcomes == {'a.py': 'translated', 'sub/b.py': 'translated',
+                            'c.py': 'cancelled', 'd.py': 'skipped'}
+        for relpath, code in codes.items():
+            filename = os.path.join(dest, *relpath.split('/'))
+            new_code = open(filename, 'rb').read().decode('utf-8')
+            if outcomes[relpath] == 'translated':
+                assert new_code == cls(code).translate()
+            else:
+                assert new_code == code
+    
+    # Changes to the tokens by the first translator do not leak
+    filename = os.path.join(dest2, 'sub', 'b.py')
+    assert 'unicode(3)' in open(filename, 'rb').read().decode('utf-8')
+    
+    # The sources are untouched
+    for relpath, code in codes.items():
+        filename = os.path.join(dirname, *relpath.split('/'))
+        assert open(filename, 'rb').read().decode('utf-8') == code
+
+
+def test_incremental_translator():
+    
+    class CountingTranslator(LegacyPythonTranslator):
+        count = 0
+        def __init__(self, text):
+            CountingTranslator.count += 1
+            LegacyPythonTranslator.__init__(self, text)
+    
+    code = '"""docstring"""\n\nimport queue\n\n'
+    for i in range(50):
+        code += 'class Foo%i:\n    def bar(self):\n        range(3)\n' % i
+    
+    t = IncrementalTranslator(code, CountingTranslator)
+    assert t.output == LegacyPythonTranslator(code).translate()
+    
+    def check_edit(offset, removed, inserted):
+        text = t.text[:offset] + inserted + t.text[offset+removed:]
+        output = t.output
+        o, r, ins = t.edit(offset, removed, inserted)
+        assert t.text == text
+        assert t.output == LegacyPythonTranslator(text).translate()
+        assert t.output == output[:o] + ins + output[o+r:]
+    
+    # Edits only re-translate the blocks nearby
+    CountingTranslator.count = 0
+    i = code.index('range(3)', len(code) // 2)
+    check_edit(i, 5, 'str')
+    check_edit(i + 3, 0, 'x')
+    check_edit(i + 3, 1, '')
+    assert CountingTranslator.count <= 9
+    
+    # Adding functions and methods
+    i = t.text.index('class Foo7')
+    check_edit(i, 0, 'def spam():\n    super().x\n')
+    check_edit(i + 12, 0, '    super().y\n')
+    i = t.text.index('class Foo8')
+    check_edit(i - 1, 0, '\n    def eggs(self):\n        super().z')
+    assert 'super().x' in t.output
+    assert 'super(Foo7, self).z' in t.output
+    
+    # Fixer state is passed to the next block: future import after docstring
+    check_edit(0, 15, '')
+    check_edit(0, 0, '# comment\n"""doc"""\n')
+    assert t.output.index('__future__') > t.output.index('doc')
+    
+    # Opening and closing multi-line strings
+    i = t.text.index('class Foo20')
+    check_edit(i, 0, "'''\n")
+    assert 'class Foo30:' in t.output
+    check_edit(i + 4, 0, "'''\n")
+    assert 'class Foo30(object):' in t.output
+    check_edit(i, 8, '')
+    
+    # Cancel
+    t.edit(0, 0, 'from __future__ import division\n')
+    assert t.cancelled
+    assert t.output == t.text
+    t.edit(0, 32, '')
+    assert not t.cancelled
+    check_edit(len(t.text), 0, '\nrange(2)')
+    check_edit(0, len(t.text), '')
+    assert t.output == LegacyPythonTranslator('').translate()
+    
+    raises(ValueError, t.edit, 1, 0, '')
+    
+    # Statements that continue over multiple lines
+    t = IncrementalTranslator('x = 1\n')
+    t.edit(0, 0, 'y = isinstance(x,\nstr)\n')
+    assert 'basestring' in t.output
+    t = IncrementalTranslator('x = 1\n')
+    t.edit(0, 0, 'y = isinstance(x, \\\nstr)\n')
+    assert 'basestring' in t.output
+    
+    # Fixer state is copied, not deep-copied
+    class StateTranslator(LegacyPythonTranslator):
+        STATE_ATTRS = LegacyPythonTranslator.STATE_ATTRS + ('_last', )
+        def fix_last(self, token):
+            self._last = token
+    t = IncrementalTranslator('x = 1\ny = 2\n', StateTranslator)
+    t.edit(0, 1, 'z')
+    assert t.output == StateTranslator(t.text).translate()
+
+
+def test_incremental_translator_errors():
+    
+    # A fixer error keeps the last good output, and the object usable
+    t = IncrementalTranslator('x = 1\nclass Foo:\n    pass\ny = range(2)\n')
+    t.edit(6, 11, 'class\nclass Foo:')
+    assert len(t.errors) == 1
+    assert 'y = xrange(2)' in t.output
+    t.edit(6, 6, '')
+    assert not t.errors
+    assert t.output == LegacyPythonTranslator(t.text).translate()
+    
+    # Typing a class definition one char at a time
+    code = 'x = 1\nclass Foo:\n    def bar(self):\n        super().bar()\n'
+    t = IncrementalTranslator('y = range(2)\n')
+    for c in code:
+        t.edit(len(t.text), 0, c)
+        assert 'y = xrange(2)\n' in t.output
+    assert not t.errors
+    assert t.output == LegacyPythonTranslator(t.text).translate()
+
+
+def test_incremental_translator_random():
+    
+    pieces = ['x', ' ', '\n', '\n    ', '#', '(', ')', '[', ']', "'", '"',
+              '\\\n', 'range(3)', 'isinstance(x,\nstr)', '1/2\n',
+              'class Foo:\n    def f(self):\n        super().f()\n',
+              'from __future__ import division\n']
+    rnd = random.Random(0)
+    t = IncrementalTranslator('"""docstring"""\n\nimport queue\n')
+    for i in range(300):
+        offset = rnd.randint(0, len(t.text))
+        removed = rnd.randint(0, min(3, len(t.text) - offset))
+        inserted = rnd.choice(pieces) if rnd.random() < 0.8 else ''
+        output = t.output
+        o, r, ins = t.edit(offset, removed, inserted)
+        assert t.output == output[:o] + ins + output[o+r:]
+        if t.errors:
+            continue
+        try:
+            output = LegacyPythonTranslator(t.text).translate()
+        except CancelTranslation:
+            assert t.cancelled
+        except Exception:
+            pass
+        else:
+            assert t.output == output
+
+
 ## Fixers
 
 
@@ -178,6 +704,13 @@ def test_fix_super():
                     super().eggs()
     def spam():
         super().x
+    class Foo3:
+        class Foo4:
+            def bar(self):
+                def helper():
+                    pass
+                super().bar()
+        def spam(self):  super().spam()
     super().y
     """
     new_code = LegacyPythonTranslator(code).translate()
@@ -190,6 +723,69 @@ def test_fix_super():
     assert 'super(Foo, self).bar()' in new_code
     assert 'super(Foo, self).spam()' in new_code
     assert 'super(Foo2, self).eggs()' in new_code
+    assert 'super(Foo4, self).bar()' in new_code
+    assert 'super(Foo3, self).spam()' in new_code
+    
+    # Continuation lines do not end the class
+    for line in ('x = foo(\n1)', 'x = 1 + \\\n2'):
+        code = ('class Foo:\n    %s\n    def bar(self):\n'
+                '        super().bar()\n' % line)
+        new_code = LegacyPythonTranslator(code).translate()
+        assert 'super(Foo, self).bar()' in new_code
+
+
+def test_scopes():
+    code = """
+    x = 1
+    @decorator
+    class Foo:
+        '''docstring
+    '''
+        def bar(self, a,
+                b):
+            def spam():
+                pass
+    # comment
+            return a
+        y = 2
+    async def eggs(): x
+    z = 3
+    """
+    tokens = dict((t.text, t) for t in BaseTranslator(code).tokens)
+    assert tokens['x'].enclosing_class is None
+    assert tokens['decorator'].enclosing_class is None
+    assert tokens['Foo'].enclosing_class.name == 'Foo'
+    assert tokens['Foo'].enclosing_function is None
+    assert tokens["'''docstring\n    '''"].enclosing_class.name == 'Foo'
+    assert tokens['b'].enclosing_function.name == 'bar'
+    assert tokens['pass'].enclosing_function.name == 'spam'
+    assert tokens['pass'].enclosing_function.parent.name == 'bar'
+    assert tokens['pass'].enclosing_class.name == 'Foo'
+    assert tokens['return'].enclosing_function.name == 'bar'
+    assert tokens['y'].enclosing_function is None
+    assert tokens['y'].enclosing_class.name == 'Foo'
+    assert tokens['eggs'].enclosing_function.name == 'eggs'
+    assert tokens['eggs'].enclosing_class is None
+    assert tokens['z'].enclosing_function is None
+    assert tokens['z'].enclosing_class is None
+    
+    # Continuation lines are part of the logical line
+    code = 'class Foo:\n    x = foo(\n1)\n    y = 1 + \\\n2\n    z = 3\nw = 4\n'
+    tokens = dict((t.text, t) for t in BaseTranslator(code).tokens)
+    for name in ('1', '2', 'y', 'z'):
+        assert tokens[name].enclosing_class.name == 'Foo'
+    assert tokens['w'].enclosing_class is None
+    
+    # Tokens that are not part of a translator
+    assert Token(code, '', 0, 1).enclosing_class is None
+    
+    # The tree is built on first use, once
+    translator = LegacyPythonTranslator('x = range(3)\n')
+    translator.translate()
+    assert translator._scope_tree._scopes is None
+    translator = LegacyPythonTranslator(code)
+    scopes = translator.tokens[0].scope_tree.scopes
+    assert translator.tokens[-1].scope_tree.scopes is scopes
 
 
 def test_fix_future():
@@ -265,6 +861,40 @@ def test_fix_range():
     assert 'y.range()' in new_code
 
 
+def test_renames():
+    
+    class MyTranslator(BaseTranslator):
+        RENAMES = (
+            ('foo', 'bar', None, '('),
+            ('foo', 'spam', '=', None),
+            ('eggs', 'ham', '!.', None),
+            ) + tuple([('x%i' % i, 'y', None, None) for i in range(1000)])
+    
+    code = """
+    foo(1)
+    a = foo
+    foo
+    eggs
+    x.eggs
+    x3
+    'foo(2)'
+    """
+    new_code = MyTranslator(code).translate()
+    assert 'bar(1)' in new_code
+    assert 'a = spam' in new_code
+    assert '\n    foo\n' in new_code
+    assert '\n    ham\n' in new_code
+    assert 'x.eggs' in new_code
+    assert '\n    y\n' in new_code
+    assert "'foo(2)'" in new_code
+    
+    # Rules are compiled per class
+    class MyTranslator2(MyTranslator):
+        RENAMES = MyTranslator.RENAMES + (('foo', 'X', None, None), )
+    assert MyTranslator2('foo').translate() == 'X'
+    assert MyTranslator('foo').translate() == 'foo'
+
+
 def test_fix_encode():
     code = """
     b = s.encode()
@@ -11,8 +11,20 @@ code in Python 3, and convert it to Python 2.7 at install time.
 
 from __future__ import print_function
 
+import bisect
+import copy
+import hashlib
+import io
+import json
+import marshal
 import os
 import re
+import tempfile
+import threading
+import timeit
+import tokenize
+import zlib
+from collections import OrderedDict
 
 # List of fixers from lib3to2: absimport annotations bitlength bool
 # bytes classdecorator collections dctsetcomp division except features
@@ -49,6 +61,22 @@ endProgs = {
     }
 
 
+def _bracket_depth(depth, code):
+    """ Update the bracket depth with the brackets in the given piece of
+    code (which should not contain strings or comments).
+    """
+    depth += code.count('(') + code.count('[') + code.count('{')
+    depth -= code.count(')') + code.count(']') + code.count('}')
+    return max(0, depth)
+
+
+def _is_continued(code):
+    """ Whether the given piece of code (up to a newline) ends with a
+    backslash, i.e. the line continues on the next line.
+    """
+    return code.rstrip('\r').endswith('\\')
+
+
 class CancelTranslation(RuntimeError):
     pass  # to cancel a translation
 
@@ -69,6 +97,7 @@ class Token:
         self.start = start
         self.end = end
         self.fix = None
+        self.scope_tree = None
     
     def __repr__(self):
         return '<token %r>' % self.text
@@ -120,6 +149,28 @@ class Token:
         line2 = line1.lstrip()
         return len(line1) - len(line2)
     
+    @property
+    def enclosing_class(self):
+        """ The innermost class (a Scope object) that this token is
+        part of, or None.
+        """
+        return self._find_scope('class')
+    
+    @property
+    def enclosing_function(self):
+        """ The innermost function (a Scope object) that this token is
+        part of, or None.
+        """
+        return self._find_scope('def')
+    
+    def _find_scope(self, kind):
+        if self.scope_tree is None:
+            return None
+        scope = self.scope_tree.find(self.start)
+        while scope is not None and scope.kind != kind:
+            scope = scope.parent
+        return scope
+    
     @property
     def line_tokens(self):
         """ All (non-comment) tokens that are on the same line.
@@ -139,52 +190,130 @@ class Token:
         return tokens
 
 
-class BaseTranslator:
-    """ Translate Python code. One translator instance is used to
-    translate one file.
+class Scope:
+    """ A class or function definition in the source code. The ``kind``
+    is 'class' or 'def', and ``start`` and ``end`` denote the range in
+    the text, from the start of the line with the header to the end of
+    the last token in the body.
     """
     
-    def __init__(self, text):
-        self._text = text
-        self._tokens = None
+    def __init__(self, kind, name, indentation, start, parent):
+        self.kind = kind
+        self.name = name
+        self.indentation = indentation
+        self.start = start
+        self.end = start
+        self.parent = parent
+    
+    def __repr__(self):
+        return '<Scope %s %s>' % (self.kind, self.name)
+
+
+class ScopeTree:
+    """ The tree of class and function definitions, derived from the
+    indentation of the tokens. Can be used to find the innermost scope
+    for a position in O(log n). The tree is built on first use, so that
+    code that does not need it does not pay for it.
+    """
+    
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self._scopes = None
     
     @property
-    def tokens(self):
-        """ The list of tokens.
+    def scopes(self):
+        """ The list of Scope objects, in order of appearance.
         """
-        if self._tokens is None:
-            self._parse()
-        return self._tokens
+        if self._scopes is None:
+            self._build()
+        return self._scopes
     
-    def _parse(self):
-        """ Generate tokens by parsing the code.
+    def _build(self):
+        self._scopes = []
+        stack = []
+        indentation = depth = 0
+        line_start = prev_end = 0
+        for token in self._tokens:
+            text = token.total_text
+            depth = _bracket_depth(depth, text[prev_end:token.start])
+            i = text.rfind('\n', 0, token.start) + 1
+            if (i != line_start and prev_end <= i and depth == 0 and
+                    not _is_continued(text[prev_end:i-1])):
+                # First token on a new logical line; close scopes when
+                # dedenting
+                line_start = i
+                line = text[i:token.start]
+                indentation = len(line) - len(line.lstrip())
+                if token.type != 'comment':
+                    while stack and indentation <= stack[-1].indentation:
+                        stack.pop().end = prev_end
+            if token.type == 'keyword' and token.text in ('class', 'def'):
+                name = token.next_token.text if token.next_token else ''
+                scope = Scope(token.text, name, indentation, line_start,
+                              stack[-1] if stack else None)
+                self._scopes.append(scope)
+                stack.append(scope)
+            prev_end = token.end
+        for scope in stack:
+            scope.end = prev_end
+        
+        self._starts = [scope.start for scope in self._scopes]
+        self._tokens = None  # no longer needed
+    
+    def find(self, pos):
+        """ Get the innermost scope that contains the given position, or
+        None.
+        """
+        scopes = self.scopes
+        i = bisect.bisect_right(self._starts, pos) - 1
+        scope = scopes[i] if i >= 0 else None
+        while scope is not None and pos >= scope.end:
+            scope = scope.parent
+        return scope
+
+
+class BaseTokenizer:
+    """ Base class for tokenizer backends. A tokenizer turns the source
+    text into a list of (unlinked) tokens. The ``version`` should be
+    increased whenever a change affects the produced tokens.
+    """
+    
+    name = ''
+    version = 0
+    
+    @classmethod
+    def tokenize(cls, text):
+        """ Get a list of tokens for the given text.
         """
-        self._tokens = []
+        raise NotImplementedError()
+
+
+class RegexTokenizer(BaseTokenizer):
+    """ The default tokenizer, based on regular expressions. It is fast,
+    but approximate, e.g. it does not know about all string prefixes.
+    """
+    
+    name = 'regex'
+    version = 1
+    
+    @classmethod
+    def tokenize(cls, text):
+        tokens = []
         pos = 0
-        
-        # Find tokens
         while True:
-            token = self._find_next_token(pos)
+            token = cls.next_token(text, pos)
             if token is None:
                 break
-            self._tokens.append(token)
+            tokens.append(token)
             pos = token.end
-        
-        # Link tokens
-        if self._tokens:
-            self._tokens[0].prev_token = None
-            self._tokens[len(self._tokens)-1].next_token = None
-        for i in range(0, len(self._tokens)-1):
-            self._tokens[i].next_token = self._tokens[i+1]
-        for i in range(1, len(self._tokens)):
-            self._tokens[i].prev_token = self._tokens[i-1]
+        return tokens
     
-    def _find_next_token(self, pos):
-        """ Returns a token or None if no new tokens can be found.
+    @classmethod
+    def next_token(cls, text, pos):
+        """ Returns the first token at or after pos, or None if no new
+        tokens can be found.
         """
         
-        text = self._text
-        
         # Init tokens, if pos too large, were done
         if pos > len(text):
             return None
@@ -206,7 +335,8 @@ class BaseTranslator:
             # not backslash) before the end char(s).
             start = match.start()
             string_style = match.group(3)
-            end = endProgs[string_style].search(text, match.end() - 1).end()
+            end_match = endProgs[string_style].search(text, match.end() - 1)
+            end = end_match.end() if end_match else len(text)  # unterminated
             return Token(text, 'string', start, end)
         else:
             # Identifier ("a word or number") Find out whether it is a key word
@@ -218,11 +348,242 @@ class BaseTranslator:
                 return Token(text, 'number', *tokenArgs)
             else:
                 return Token(text, 'identifier', *tokenArgs)
+
+
+class StdlibTokenizer(BaseTokenizer):
+    """ A tokenizer based on the tokenize module from the standard
+    library. It is slower than the regex tokenizer, but understands all
+    string prefixes, f-strings and line continuations. The code must be
+    valid Python for the running interpreter.
+    """
+    
+    name = 'stdlib'
+    version = 1
+    
+    @classmethod
+    def tokenize(cls, text):
+        
+        # Tokenize reports (row, col) positions, so get start of each line
+        line_starts = [0, 0]  # rows are 1-based
+        i = text.find('\n')
+        while i >= 0:
+            line_starts.append(i + 1)
+            i = text.find('\n', i + 1)
+        line_starts.append(len(text))  # for NEWLINE/ENDMARKER at the end
+        
+        # Tokens that start/end an f-string (Python 3.12+) or t-string
+        fstring_starts = (getattr(tokenize, 'FSTRING_START', None),
+                          getattr(tokenize, 'TSTRING_START', None))
+        fstring_ends = (getattr(tokenize, 'FSTRING_END', None),
+                        getattr(tokenize, 'TSTRING_END', None))
+        
+        tokens = []
+        depth = 0
+        readline = io.StringIO(text).readline
+        for tok in tokenize.generate_tokens(readline):
+            toktype, string = tok[0], tok[1]
+            start = line_starts[tok[2][0]] + tok[2][1]
+            end = line_starts[tok[3][0]] + tok[3][1]
+            if toktype in fstring_starts and toktype is not None:
+                if depth == 0:
+                    fstring_start = start
+                depth += 1
+            elif toktype in fstring_ends and toktype is not None:
+                depth -= 1
+                if depth == 0:
+                    tokens.append(Token(text, 'string', fstring_start, end))
+            elif depth > 0:
+                pass  # part of an f-string
+            elif toktype == tokenize.COMMENT:
+                tokens.append(Token(text, 'comment', start, end))
+            elif toktype == tokenize.STRING:
+                tokens.append(Token(text, 'string', start, end))
+            elif toktype == tokenize.NUMBER:
+                tokens.append(Token(text, 'number', start, end))
+            elif toktype == tokenize.NAME:
+                if string in KEYWORDS:
+                    tokens.append(Token(text, 'keyword', start, end))
+                else:
+                    tokens.append(Token(text, 'identifier', start, end))
+        return tokens
+
+
+def compare_tokenizers(sources, tokenizers=None, repeat=3):
+    """ Benchmark tokenizer backends and compare their output on a corpus.
+    The sources can be a directory name (all .py files in it are used)
+    or a list of source strings. The first of the given tokenizers (by
+    default all backends) serves as the reference. Returns a dict that
+    maps tokenizer names to a dict with the best total ``time`` (in
+    seconds) and a list of ``mismatches``: the sources (relative paths
+    or indices) for which the tokens differ from the reference, or for
+    which the tokenizer failed.
+    """
+    if tokenizers is None:
+        tokenizers = RegexTokenizer, StdlibTokenizer
+    
+    # Collect the corpus
+    if isinstance(sources, str):
+        dirname, sources, names = sources, [], []
+        for root, dirs, files in os.walk(dirname):
+            for fname in sorted(files):
+                if fname.endswith('.py'):
+                    filename = os.path.join(root, fname)
+                    with open(filename, 'rb') as f:
+                        sources.append(f.read().decode('utf-8'))
+                    names.append(os.path.relpath(filename, dirname))
+    else:
+        sources = list(sources)
+        names = list(range(len(sources)))
+    
+    results = {}
+    reference = None
+    for tokenizer in tokenizers:
+        # Get tokens as tuples, record failures
+        signatures = []
+        for text in sources:
+            try:
+                tokens = tokenizer.tokenize(text)
+            except Exception:
+                signatures.append(None)
+            else:
+                signatures.append([(t.type, t.start, t.end) for t in tokens])
+        if reference is None:
+            reference = signatures
+        mismatches = [name for name, sig, ref in
+                      zip(names, signatures, reference)
+                      if sig is None or sig != ref]
+        # Time it, using only the sources that the tokenizer can handle
+        ok_sources = [text for text, sig in zip(sources, signatures)
+                      if sig is not None]
+        best = float('inf')
+        for i in range(repeat):
+            t0 = timeit.default_timer()
+            for text in ok_sources:
+                tokenizer.tokenize(text)
+            best = min(best, timeit.default_timer() - t0)
+        results[tokenizer.name] = dict(time=best, mismatches=mismatches)
+    
+    return results
+
+
+class BaseTranslator:
+    """ Translate Python code. One translator instance is used to
+    translate one file.
+    """
+    
+    TOKENIZER = RegexTokenizer
+    
+    def __init__(self, text):
+        self._text = text
+        self._tokens = None
+    
+    @property
+    def tokens(self):
+        """ The list of tokens.
+        """
+        if self._tokens is None:
+            self._parse()
+        return self._tokens
+    
+    def _parse(self):
+        """ Generate tokens by parsing the code.
+        """
+        self._set_tokens(self.TOKENIZER.tokenize(self._text))
+    
+    def _set_tokens(self, tokens, scope_tree=None):
+        """ Set the list of tokens and link them. The scope tree is built
+        from the tokens, unless given.
+        """
+        self._tokens = tokens
+        
+        # The scope tree is only built when a token asks for it
+        if scope_tree is None:
+            scope_tree = ScopeTree(tokens)
+        self._scope_tree = scope_tree
+        
+        # Link tokens
+        prev_token = None
+        for token in tokens:
+            token.prev_token = prev_token
+            token.scope_tree = scope_tree
+            if prev_token is not None:
+                prev_token.next_token = token
+            prev_token = token
+        if prev_token is not None:
+            prev_token.next_token = None
+    
+    # Simple renames of identifiers: (name, replacement, prev_char,
+    # next_char). The chars specify the required neighboring chars, or
+    # the forbidden char when prefixed with '!'. None means any char.
+    RENAMES = ()
+    
+    # Names of the attributes in which fixers keep state while walking
+    # over the tokens. The IncrementalTranslator passes these on.
+    STATE_ATTRS = ()
+    
+    @classmethod
+    def _get_rename_table(cls):
+        """ Get a dict that maps identifier names to a list of rename
+        rules. Compiled once per class.
+        """
+        compiled = cls.__dict__.get('_rename_table', None)
+        if compiled is None or compiled[0] is not cls.RENAMES:
+            table = {}
+            for name, replacement, prev_char, next_char in cls.RENAMES:
+                conditions = []
+                for char in (prev_char, next_char):
+                    if char is None:
+                        conditions.append((None, False))
+                    elif len(char) == 2 and char.startswith('!'):
+                        conditions.append((char[1], True))
+                    else:
+                        conditions.append((char, False))
+                table.setdefault(name, []).append(
+                    (conditions[0], conditions[1], replacement))
+            compiled = cls.RENAMES, table
+            cls._rename_table = compiled
+        return compiled[1]
+    
+    def _apply_renames(self):
+        """ Apply the rename rules in a single pass over the identifiers.
+        """
+        table = self._get_rename_table()
+        if not table:
+            return
+        for token in self.tokens:
+            if token.type != 'identifier':
+                continue
+            rules = table.get(token.text, None)
+            if rules is None:
+                continue
+            prev_char = next_char = None  # only get these when needed
+            for (pchar, pnegate), (nchar, nnegate), replacement in rules:
+                if pchar is not None:
+                    if prev_char is None:
+                        prev_char = token.prev_char
+                    if (prev_char == pchar) == pnegate:
+                        continue
+                if nchar is not None:
+                    if next_char is None:
+                        next_char = token.next_char
+                    if (next_char == nchar) == nnegate:
+                        continue
+                token.fix = replacement
+                break
     
     def translate(self):
         """ Translate the code by applying fixes to the tokens. Returns
         the new code as a string.
         """
+        self._apply_fixers()
+        return self.dumps()
+    
+    def _apply_fixers(self):
+        """ Apply the renames and fixers to the tokens.
+        """
+        
+        # Apply simple renames
+        self._apply_renames()
         
         # Collect fixers. Sort by name, so at least its consistent.
         fixers = []
@@ -245,8 +606,6 @@ class BaseTranslator:
         # Insert new tokens
         for i, new_token in reversed(new_tokens):
             self._tokens.insert(i, new_token)
-        
-        return self.dumps()
     
     def dumps(self):
         """ Return a string with the translated code.
@@ -262,32 +621,441 @@ class BaseTranslator:
         return ''.join(reversed(pieces))
     
     @classmethod
-    def translate_dir(cls, dirname, skip=()):
+    def translate_dir(cls, dirname, skip=(), shard_index=0, shard_count=1,
+                      manifest=None, progress=True, cache_dir=None):
         """ Classmethod to translate all .py files in the given
         directory and its subdirectories. Skips files that match names
         in skip (which can be full file names, absolute paths, and paths
         relative to dirname). Any file that imports 'print_function'
         from __future__ is cancelled.
+        
+        To split the work over multiple processes or machines, set
+        shard_count and a shard_index for each process; files are
+        assigned to shards by a stable hash of their relative path.
+        If manifest is given, the outcome for each file in this shard is
+        written to that (json) file; use ``merge_manifests()`` to combine
+        the manifests of all shards.
+        
+        If progress is True, a summary is printed at the end. If it is a
+        callable, it is called with a ``TranslationResult`` for each file.
+        If it is False, nothing is reported. Returns a dict that maps
+        relative paths to outcomes.
+        
+        If cache_dir is given, the tokens of each file are cached there
+        (see ``TokenCache``), so that subsequent runs (also with other
+        fixers) can skip tokenizing unchanged sources.
         """
+        outcomes = {}
+        totals = dict(duration=0.0, bytes_in=0, bytes_out=0)
+        for result in cls.iter_translate_dir(dirname, skip, shard_index,
+                                             shard_count, cache_dir,
+                                             stats=bool(progress)):
+            outcomes[result.path] = result.outcome
+            if progress is True:
+                for key in totals:
+                    totals[key] += getattr(result, key)
+            elif progress:
+                progress(result)
+        
+        if progress is True:
+            print(_summarize(cls.__name__, outcomes, totals))
+        
+        if manifest:
+            d = dict(translator=cls.__name__, shard_index=shard_index,
+                     shard_count=shard_count, files=outcomes)
+            with open(manifest, 'wb') as f:
+                f.write(json.dumps(d, indent=1, sort_keys=True).encode())
+        return outcomes
+    
+    @classmethod
+    def iter_translate_dir(cls, dirname, skip=(), shard_index=0,
+                           shard_count=1, cache_dir=None, stats=True):
+        """ Classmethod that translates the files like ``translate_dir()``,
+        but yields a ``TranslationResult`` for each file. If stats is
+        False, the duration and number of fixes are not measured (and
+        reported as zero).
+        """
+        if not 0 <= shard_index < shard_count:
+            raise ValueError('Invalid shard_index %r for shard_count %r' %
+                             (shard_index, shard_count))
+        token_cache = TokenCache(cache_dir) if cache_dir else None
+        for filename, key, skipped in _iter_py_files(dirname, skip,
+                                                     shard_index,
+                                                     shard_count):
+            if skipped:
+                yield TranslationResult(key, 'skipped',
+                                        translator=cls.__name__)
+                continue
+            t0 = timeit.default_timer() if stats else 0.0
+            data = open(filename, 'rb').read()
+            code = data.decode('utf-8')
+            translator = cls(code)
+            if token_cache is not None:
+                translator._set_tokens(token_cache.tokenize(code,
+                                                            cls.TOKENIZER))
+            try:
+                new_code = translator.translate()
+            except CancelTranslation:
+                duration = timeit.default_timer() - t0 if stats else 0.0
+                yield TranslationResult(key, 'cancelled', duration,
+                                        len(data), translator=cls.__name__)
+            else:
+                new_data = new_code.encode('utf-8')
+                with open(filename, 'wb') as f:
+                    f.write(new_data)
+                duration, fixes = 0.0, 0
+                if stats:
+                    duration = timeit.default_timer() - t0
+                    fixes = sum(1 for t in translator.tokens
+                                if t.fix is not None)
+                yield TranslationResult(key, 'translated', duration,
+                                        len(data), len(new_data), fixes,
+                                        translator=cls.__name__)
+
+
+def _iter_py_files(dirname, skip, shard_index=0, shard_count=1):
+    """ Yield (filename, relpath, skipped) for each .py file in the given
+    directory (and the given shard). The relpath uses forward slashes.
+    """
+    dirname = os.path.normpath(dirname)
+    skip = [os.path.normpath(p) for p in skip]
+    for root, dirs, files in os.walk(dirname):
+        for fname in files:
+            if fname.endswith('.py'):
+                filename = os.path.join(root, fname)
+                relpath = os.path.relpath(filename, dirname)
+                key = relpath.replace(os.sep, '/')
+                if shard_count > 1:
+                    if get_shard(key, shard_count) != shard_index:
+                        continue
+                skipped = fname in skip or relpath in skip or filename in skip
+                yield filename, key, skipped
+
+
+def _summarize(name, outcomes, totals):
+    """ Get a one-line summary of the translation of a directory.
+    """
+    counts = dict((outcome, 0) for outcome in
+                  ('translated', 'cancelled', 'skipped'))
+    for outcome in outcomes.values():
+        counts[outcome] += 1
+    return ('%s: %i translated, %i cancelled, %i skipped '
+            '(%i bytes in %0.2f s)' %
+            (name, counts['translated'], counts['cancelled'],
+             counts['skipped'], totals['bytes_in'], totals['duration']))
+
+
+def translate_dir_multi(dirname, targets, skip=(), progress=True,
+                        cache_dir=None):
+    """ Translate all .py files in the given directory with multiple
+    translator classes. The targets is a list of (translator_class,
+    dest_dirname) tuples. Each file is read and tokenized once; each
+    translator gets its own copy of the tokens to apply its fixers to.
+    The results are written to the same relative path in the destination
+    directories; skipped and cancelled files are written unchanged. The
+    skip, progress and cache_dir arguments are as in ``translate_dir()``.
+    Returns a dict that maps each translator class to a dict of outcomes.
+    """
+    token_cache = TokenCache(cache_dir) if cache_dir else None
+    all_outcomes = dict((cls, {}) for cls, dest in targets)
+    all_totals = dict((cls, dict(duration=0.0, bytes_in=0, bytes_out=0))
+                      for cls, dest in targets)
+    
+    for filename, key, skipped in _iter_py_files(dirname, skip):
+        data = open(filename, 'rb').read()
+        code = None if skipped else data.decode('utf-8')
+        shared = {}  # tokenizer -> (rows, scope_tree)
+        
+        for cls, dest in targets:
+            t0 = timeit.default_timer() if progress else 0.0
+            new_data = data
+            if skipped:
+                result = TranslationResult(key, 'skipped',
+                                           translator=cls.__name__)
+            else:
+                # Tokenize once per tokenizer, but give each translator
+                # its own tokens, since fixers may modify them
+                tokenizer = cls.TOKENIZER
+                translator = cls(code)
+                if tokenizer in shared:
+                    rows, scope_tree = shared[tokenizer]
+                    translator._set_tokens([Token(code, type, start, end)
+                                            for type, start, end in rows],
+                                           scope_tree)
+                else:
+                    if token_cache is not None:
+                        tokens = token_cache.tokenize(code, tokenizer)
+                    else:
+                        tokens = tokenizer.tokenize(code)
+                    rows = [(t.type, t.start, t.end) for t in tokens]
+                    translator._set_tokens(tokens)
+                    shared[tokenizer] = rows, translator._scope_tree
+                try:
+                    new_data = translator.translate().encode('utf-8')
+                except CancelTranslation:
+                    duration = timeit.default_timer() - t0 if progress else 0.0
+                    result = TranslationResult(key, 'cancelled', duration,
+                                               len(data),
+                                               translator=cls.__name__)
+                else:
+                    duration, fixes = 0.0, 0
+                    if progress:
+                        duration = timeit.default_timer() - t0
+                        fixes = sum(1 for t in translator.tokens
+                                    if t.fix is not None)
+                    result = TranslationResult(key, 'translated', duration,
+                                               len(data), len(new_data), fixes,
+                                               translator=cls.__name__)
+            
+            # Write
+            dest_filename = os.path.join(dest, *key.split('/'))
+            if not os.path.isdir(os.path.dirname(dest_filename)):
+                os.makedirs(os.path.dirname(dest_filename))
+            with open(dest_filename, 'wb') as f:
+                f.write(new_data)
+            
+            # Report
+            all_outcomes[cls][key] = result.outcome
+            if progress is True:
+                for k in all_totals[cls]:
+                    all_totals[cls][k] += getattr(result, k)
+            elif progress:
+                progress(result)
+    
+    if progress is True:
+        for cls, dest in targets:
+            print(_summarize(cls.__name__, all_outcomes[cls], all_totals[cls]))
+    return all_outcomes
+
+
+# Atomic rename that overwrites. Python 2.7 does not have os.replace, but
+# os.rename does the same on posix (on Windows it fails, i.e. a miss).
+_replace = getattr(os, 'replace', os.rename)
+
+_INTS = set([int, type(2**64)])  # int and long on Python 2.7
+
+
+class TokenCache:
+    """ An on-disk cache of tokenizations. The tokens are stored as
+    compact arrays of types, starts and ends, keyed by the hash of the
+    source text and the name and version of the tokenizer. Since the
+    key does not depend on the fixers, changing the fixers does not
+    invalidate the cache.
+    """
+    
+    TYPES = 'comment', 'string', 'keyword', 'number', 'identifier'
+    
+    def __init__(self, dirname):
+        self.dirname = dirname
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):  # else created by another
+                    raise                       # process in the meantime
+    
+    def _filename(self, text, tokenizer):
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        return os.path.join(self.dirname, '%s-%i-%s.tok' %
+                            (tokenizer.name, tokenizer.version, digest))
+    
+    def get(self, text, tokenizer):
+        """ Get the list of tokens for the given text from the cache, or
+        None if it is not available.
+        """
+        TYPES = self.TYPES
+        try:
+            with open(self._filename(text, tokenizer), 'rb') as f:
+                types, starts, ends = marshal.loads(f.read())
+            types = bytearray(types)
+            if not (len(types) == len(starts) == len(ends) and
+                    set(map(type, starts)) | set(map(type, ends)) <= _INTS):
+                return None
+            return [Token(text, TYPES[i], start, end)
+                    for i, start, end in zip(types, starts, ends)]
+        except (IOError, OSError, EOFError, ValueError, TypeError,
+                IndexError):
+            return None
+    
+    def put(self, text, tokenizer, tokens):
+        """ Store the list of tokens for the given text in the cache.
+        Failing to store is not an error; it just means a cache miss
+        next time.
+        """
+        TYPES = self.TYPES
+        try:
+            types = bytes(bytearray(TYPES.index(t.type) for t in tokens))
+        except ValueError:
+            return  # custom token types cannot be stored
+        starts = [t.start for t in tokens]
+        ends = [t.end for t in tokens]
+        filename = self._filename(text, tokenizer)
+        tmp_filename = None
+        try:
+            fd, tmp_filename = tempfile.mkstemp('.tmp', dir=self.dirname)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(marshal.dumps((types, starts, ends)))
+            _replace(tmp_filename, filename)
+        except (IOError, OSError):
+            if tmp_filename and os.path.isfile(tmp_filename):
+                try:
+                    os.remove(tmp_filename)
+                except OSError:
+                    pass
+    
+    def tokenize(self, text, tokenizer):
+        """ Get the list of tokens from the cache, or tokenize the text
+        with the given tokenizer and store the result.
+        """
+        tokens = self.get(text, tokenizer)
+        if tokens is None:
+            tokens = tokenizer.tokenize(text)
+            self.put(text, tokenizer, tokens)
+        return tokens
+
+
+class TranslationResult:
+    """ The result of translating a file with ``translate_dir()``. Has
+    attributes for the relative path, the outcome ('translated',
+    'cancelled' or 'skipped'), the duration in seconds, the number of
+    bytes in and out, the number of fixes applied, and the name of the
+    translator class.
+    """
+    
+    def __init__(self, path, outcome, duration=0.0, bytes_in=0,
+                 bytes_out=0, fixes=0, translator=None):
+        self.translator = translator
+        self.path = path
+        self.outcome = outcome
+        self.duration = duration
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.fixes = fixes
+    
+    def __repr__(self):
+        return '<TranslationResult %s %r>' % (self.outcome, self.path)
+    
+    def __str__(self):
+        return '%s: %r' % (self.outcome, self.path)
+
+
+def get_shard(relpath, shard_count):
+    """ Get the shard index for a file, given its relative path (with
+    forward slashes). The result is stable across processes and machines.
+    """
+    return (zlib.crc32(relpath.encode('utf-8')) & 0xffffffff) % shard_count
+
+
+def merge_manifests(filenames, dirname=None):
+    """ Combine the manifests written by ``translate_dir()`` for each
+    shard. Checks that the manifests cover all shards exactly once and,
+    if dirname is given, that every .py file in that directory is
+    covered. Raises ValueError otherwise. Returns a dict that maps
+    relative paths to outcomes.
+    """
+    manifests = []
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            manifests.append(json.loads(f.read().decode()))
+    if not manifests:
+        raise ValueError('No manifests to merge.')
+    
+    # Check that we have each shard exactly once
+    shard_count = manifests[0]['shard_count']
+    if any(m['shard_count'] != shard_count for m in manifests):
+        raise ValueError('Manifests have different shard counts.')
+    indices = sorted(m['shard_index'] for m in manifests)
+    if indices != list(range(shard_count)):
+        raise ValueError('Expected shards 0..%i, got %r' %
+                         (shard_count - 1, indices))
+    
+    # Combine
+    outcomes = {}
+    for m in manifests:
+        for relpath, outcome in m['files'].items():
+            if get_shard(relpath, shard_count) != m['shard_index']:
+                raise ValueError('File %r in wrong shard.' % relpath)
+            outcomes[relpath] = outcome
+    
+    # Check that all files are covered
+    if dirname:
         dirname = os.path.normpath(dirname)
-        skip = [os.path.normpath(p) for p in skip]
+        missing = []
         for root, dirs, files in os.walk(dirname):
             for fname in files:
                 if fname.endswith('.py'):
-                    filename = os.path.join(root, fname)
-                    relpath = os.path.relpath(filename, dirname)
-                    if fname in skip or relpath in skip or filename in skip:
-                        print('%s skipped: %r' % (cls.__name__, relpath))
-                        continue
-                    code = open(filename, 'rb').read().decode('utf-8')
-                    try:
-                        new_code = cls(code).translate()
-                    except CancelTranslation:
-                        print('%s cancelled: %r' % (cls.__name__, relpath))
-                    else:
-                        with open(filename, 'wb') as f:
-                            f.write(new_code.encode('utf-8'))
-                        print('%s translated: %r' % (cls.__name__, relpath))
+                    relpath = os.path.relpath(os.path.join(root, fname),
+                                              dirname)
+                    relpath = relpath.replace(os.sep, '/')
+                    if relpath not in outcomes:
+                        missing.append(relpath)
+        if missing:
+            raise ValueError('Files not covered by any shard: %s' %
+                             ', '.join(sorted(missing)))
+    
+    return outcomes
+
+
+class TranslationCache:
+    """ A size-bounded in-process cache of translated strings. Results
+    are keyed by the translator class and the source text, so that a
+    cache hit only costs a hash and a dict lookup. When the cache is
+    full, the least recently used result is evicted. Cancelled
+    translations are cached too (and raise ``CancelTranslation`` again
+    on a hit). The cache can safely be shared between threads.
+    
+    Usage: ``new_code = cache.translate(LegacyPythonTranslator, code)``
+    """
+    
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._hits = self._misses = self._evictions = 0
+    
+    def translate(self, translator_class, text):
+        """ Translate the given text using the given translator class,
+        or return the cached result.
+        """
+        key = translator_class, text
+        with self._lock:
+            result = self._results.pop(key, None)
+            if result is not None:
+                self._results[key] = result  # mark as most recently used
+                self._hits += 1
+        
+        if result is None:
+            try:
+                result = translator_class(text).translate()
+            except CancelTranslation:
+                result = CancelTranslation
+            with self._lock:
+                self._misses += 1
+                self._results[key] = result
+                while len(self._results) > self.maxsize:
+                    self._results.popitem(last=False)
+                    self._evictions += 1
+        
+        if result is CancelTranslation:
+            raise CancelTranslation()
+        return result
+    
+    @property
+    def stats(self):
+        """ A dict with the number of hits, misses and evictions, and
+        the current size of the cache.
+        """
+        with self._lock:
+            return dict(hits=self._hits, misses=self._misses,
+                        evictions=self._evictions, size=len(self._results),
+                        maxsize=self.maxsize)
+    
+    def clear(self):
+        """ Remove all cached results and reset the statistics.
+        """
+        with self._lock:
+            self._results.clear()
+            self._hits = self._misses = self._evictions = 0
 
 
 class LegacyPythonTranslator(BaseTranslator):
@@ -297,6 +1065,15 @@ class LegacyPythonTranslator(BaseTranslator):
     FUTURES = ('print_function', 'absolute_import', 'with_statement',
                'unicode_literals', 'division')
     
+    STATE_ATTRS = ('_future_status', )
+    
+    RENAMES = (
+        ('range', 'xrange', '!.', '('),  # range() -> xrange()
+        ('getcwd', 'getcwdu', None, '('),  # os.getcwd -> os.getcwdu
+        ('chr', 'unichr', None, '('),  # calling chr
+        ('str', 'unicode', None, '('),  # calling str
+        )
+    
     def dumps(self):
         return '# -*- coding: utf-8 -*-\n' + BaseTranslator.dumps(self)
     
@@ -338,25 +1115,15 @@ class LegacyPythonTranslator(BaseTranslator):
     def fix_super(self, token):
         """ Fix super() -> super(Cls, self)
         """
-        # First keep track of the current class
-        if token.type == 'keyword':
-            if token.text == 'class':
-                self._current_class = token.indentation, token.next_token.text
-            elif token.text == 'def':
-                indent, name = getattr(self, '_current_class', (0, ''))
-                if token.indentation <= indent:
-                    self._current_class = 0, ''
-        
-        # Then check for super
         if token.type == 'identifier' and token.text == 'super':
             if token.prev_char != '.' and token.next_char == '(':
                 i = token.find_forward(')')
                 sub = token.total_text[token.end:i+1]
                 if re.sub(r"\s+", '', sub) == '()':
-                    indent, name = getattr(self, '_current_class', (0, ''))
-                    if name:
+                    cls = token.enclosing_class
+                    if cls is not None:
                         token.end = i + 1
-                        token.fix = 'super(%s, self)' % name
+                        token.fix = 'super(%s, self)' % cls.name
     
     # Note: we use "from __future__ import unicode_literals"
     # def fix_unicode_literals(self, token):
@@ -365,14 +1132,9 @@ class LegacyPythonTranslator(BaseTranslator):
     #             token.fix = 'u' + token.text
     
     def fix_unicode(self, token):
+        # Note: calling chr and str is handled via RENAMES
         if token.type == 'identifier':
-            if token.text == 'chr' and token.next_char == '(':
-                # Calling chr
-                token.fix = 'unichr'
-            elif token.text == 'str' and token.next_char == '(':
-                # Calling str
-                token.fix = 'unicode'
-            elif token.text == 'str' and (token.next_char == ')' and
+            if token.text == 'str' and (token.next_char == ')' and
                                           token.prev_char == '(' and
                                           token.line_tokens[0].text == 'class'):
                 token.fix = 'unicode'
@@ -385,11 +1147,6 @@ class LegacyPythonTranslator(BaseTranslator):
                     if t.text == 'str':
                         t.fix = 'basestring'
     
-    def fix_range(self, token):
-        if token.type == 'identifier' and token.text == 'range':
-            if token.next_char == '(' and token.prev_char != '.':
-                token.fix = 'xrange'
-    
     def fix_encode(self, token):
         if token.type == 'identifier' and token.text in('encode', 'decode'):
             if token.next_char == '(' and token.prev_char == '.':
@@ -398,13 +1155,6 @@ class LegacyPythonTranslator(BaseTranslator):
                     token.fix = token.text + '("utf-8")'
                     token.end = end + 1
     
-    def fix_getcwd(self, token):
-        """ Fix os.getcwd -> os.getcwdu
-        """
-        if token.type == 'identifier' and token.text == 'getcwd':
-            if token.next_char == '(':
-                token.fix = 'getcwdu'
-    
     def fix_imports(self, token):
         """ import xx.yy -> import zz
         """
@@ -533,14 +1283,277 @@ class LegacyPythonTranslator(BaseTranslator):
         }
 
 
-if __name__ == '__main__':
-    # Awesome for testing
+class IncrementalTranslator:
+    """ Keep the translation of a text up to date while the text is being
+    edited, e.g. for showing the translated code live in an editor.
+    
+    The text is divided into blocks at top-level statements (lines that
+    start with a name or keyword at column zero, outside of brackets and
+    not after a backslash). On each edit, only the damaged blocks are
+    re-tokenized and translated, so the cost depends on the size of the
+    edited statement(s) rather than the whole text. The fixer state in
+    the attributes listed in the translator's ``STATE_ATTRS`` is passed
+    from block to block; following blocks are only re-translated while
+    their incoming state differs from before. This assumes that fixers
+    only inspect tokens within the same top-level statement, and that
+    ``dumps()`` only adds a fixed prefix.
+    
+    When a fixer fails on a block (e.g. on half-typed code), the last
+    good translation of that block is used (see ``errors``).
+    """
+    
+    def __init__(self, text='', translator_class=None):
+        self._cls = translator_class or LegacyPythonTranslator
+        self._prefix = self._cls('').dumps()  # what dumps() adds
+        self._text = ''
+        self._translated = self._prefix
+        self._ncancelled = 0
+        self._blocks = []
+        # The start of each block in the text and in the translated text
+        # (excluding the prefix). Before the gap these are absolute, from
+        # the gap onwards they are relative to the end, so that an edit
+        # only needs to update the positions near the edit.
+        self._starts = []
+        self._out_starts = []
+        self._gap = 0
+        self.edit(0, 0, text)
+    
+    @property
+    def text(self):
+        """ The current (untranslated) text.
+        """
+        return self._text
+    
+    @property
+    def cancelled(self):
+        """ Whether the translation is cancelled (see CancelTranslation).
+        """
+        return self._ncancelled > 0
+    
+    @property
+    def output(self):
+        """ The translated text. If the translation is cancelled, this is
+        the original text.
+        """
+        return self._text if self._ncancelled else self._translated
+    
+    @property
+    def errors(self):
+        """ The list of exceptions raised by fixers for the current text.
+        """
+        return [block.error for block in self._blocks
+                if block.error is not None]
     
-    code = """
+    def edit(self, offset, removed, inserted):
+        """ Apply an edit to the text: at the given offset, remove the
+        given number of chars and insert the given string. Returns the
+        corresponding change to the output as a tuple (offset, removed,
+        inserted).
+        """
+        old_text, old_translated = self._text, self._translated
+        if not 0 <= offset <= offset + removed <= len(old_text):
+            raise ValueError('Edit is out of range.')
+        text = old_text[:offset] + inserted + old_text[offset+removed:]
+        old_out_len = len(old_translated) - len(self._prefix)
+        was_cancelled = self.cancelled
+        blocks, starts = self._blocks, self._starts
+        out_starts = self._out_starts
+        nblocks = len(blocks)
+        
+        # Start at the block before the one that contains the edit,
+        # because the edit might merge the two. From here on positions
+        # are relative to the end, and thus remain valid after the edit.
+        k0 = max(0, self._find_block(offset) - 1)
+        self._move_gap(k0)
+        restart = out_restart = 0
+        if k0 < nblocks:
+            restart = starts[k0] + len(old_text)
+            out_restart = out_starts[k0] + old_out_len
+        
+        # Re-tokenize to find the new blocks, until back in sync
+        bounds, m = [restart], nblocks
+        for start in self._iter_block_starts(text, restart):
+            if start >= offset + len(inserted):
+                rel = start - len(text)
+                i = bisect.bisect_left(starts, rel, k0 + 1, nblocks)
+                if i < nblocks and starts[i] == rel:
+                    m = i
+                    break
+            bounds.append(start)
+        bounds.append(starts[m] + len(text) if m < nblocks else len(text))
+        new_blocks, new_starts = [], []
+        for i1, i2 in zip(bounds[:-1], bounds[1:]):
+            if i2 > i1:
+                new_blocks.append(_Block(text[i1:i2]))
+                new_starts.append(i1)
+        
+        # Replace the old blocks. If the blocks map one-to-one (e.g. while
+        # typing inside a statement), they inherit the last good result.
+        if len(new_blocks) == m - k0:
+            for block, old_block in zip(new_blocks, blocks[k0:m]):
+                block.good = old_block.good
+        self._ncancelled -= sum(block.cancelled for block in blocks[k0:m])
+        blocks[k0:m] = new_blocks
+        starts[k0:m] = new_starts
+        out_starts[k0:m] = new_starts  # placeholders, set below
+        
+        # Translate new blocks and subsequent blocks whose state changed
+        state = blocks[k0-1].state_out if k0 > 0 else {}
+        pos = out_restart
+        i = k0
+        while i < len(blocks):
+            block = blocks[i]
+            if i >= k0 + len(new_blocks):
+                if block.state_in == state:
+                    break
+                starts[i] += len(text)  # make absolute
+            self._ncancelled -= block.cancelled
+            self._translate_block(block, state)
+            self._ncancelled += block.cancelled
+            out_starts[i] = pos
+            pos += len(block.output)
+            state = block.state_out
+            i += 1
+        self._gap = i
+        
+        # Update the translated text
+        old_out_end = out_starts[i] + old_out_len if i < len(blocks) else \
+            old_out_len
+        out_offset = len(self._prefix) + out_restart
+        out_removed = old_out_end - out_restart
+        out_inserted = ''.join(block.output for block in blocks[k0:i])
+        self._text = text
+        self._translated = (old_translated[:out_offset] + out_inserted +
+                            old_translated[out_offset + out_removed:])
+        
+        if was_cancelled and self.cancelled:
+            return offset, removed, inserted
+        elif not was_cancelled and not self.cancelled:
+            return out_offset, out_removed, out_inserted
+        else:
+            old_output = old_text if was_cancelled else old_translated
+            return 0, len(old_output), self.output
+    
+    def _find_block(self, offset):
+        """ Get the index of the block that contains the given offset.
+        """
+        starts, gap, n = self._starts, self._gap, len(self._text)
+        if gap < len(starts) and offset >= starts[gap] + n:
+            i = bisect.bisect_right(starts, offset - n, gap)
+        else:
+            i = bisect.bisect_right(starts, offset, 0, gap)
+        return max(0, i - 1)
+    
+    def _move_gap(self, gap):
+        """ Move the gap, making positions before it absolute, and
+        positions after it relative to the end.
+        """
+        starts, out_starts = self._starts, self._out_starts
+        n = len(self._text)
+        m = len(self._translated) - len(self._prefix)
+        while self._gap < gap:
+            starts[self._gap] += n
+            out_starts[self._gap] += m
+            self._gap += 1
+        while self._gap > gap:
+            self._gap -= 1
+            starts[self._gap] -= n
+            out_starts[self._gap] -= m
+    
+    def _iter_block_starts(self, text, pos):
+        """ Yield the positions (after pos) of the newlines that precede
+        a top-level statement. The text at pos must be at such a position
+        (or at the start of the text).
+        """
+        depth = 0
+        prev_end = pos
+        while True:
+            token = RegexTokenizer.next_token(text, prev_end)
+            if token is None:
+                break
+            between = text[prev_end:token.start]
+            depth = _bracket_depth(depth, between)
+            if (depth == 0 and token.type != 'comment' and
+                    token.start - 1 > pos and between.endswith('\n') and
+                    not _is_continued(between[:-1])):
+                yield token.start - 1
+            prev_end = token.end
+    
+    def _translate_block(self, block, state):
+        block.state_in = state
+        block.cancelled, block.error = False, None
+        t = self._cls(block.text)
+        for key, val in state.items():
+            setattr(t, key, copy.copy(val))
+        try:
+            t._apply_fixers()
+        except CancelTranslation:
+            block.output, block.state_out = block.text, state
+            block.cancelled = True
+        except Exception as err:
+            block.error = err
+            if block.good is not None:
+                block.output, block.state_out = block.good
+            else:
+                block.output, block.state_out = block.text, state
+        else:
+            block.output = BaseTranslator.dumps(t)
+            block.state_out = dict((key, getattr(t, key))
+                                   for key in self._cls.STATE_ATTRS
+                                   if key in t.__dict__)
+            block.good = block.output, block.state_out
+
+
+class _Block:
+    """ A top-level statement in the IncrementalTranslator.
     """
     
-    t = LegacyPythonTranslator(code)
-    new_code = t.translate()
-    print(t.tokens)
-    print('---')
-    print(new_code)
+    def __init__(self, text):
+        self.text = text
+        self.output = text  # or the original text if cancelled
+        self.state_in = self.state_out = None
+        self.cancelled = False
+        self.error = None
+        self.good = None  # last successful (output, state_out)
+
+
+def main(argv=None):
+    """ Command line interface to translate a directory in-place with the
+    LegacyPythonTranslator, or to merge the manifests of shards.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Translate Python 3 code to Python 2.7 (in-place).')
+    parser.add_argument('dirname', help='directory to translate')
+    parser.add_argument('--skip', nargs='*', default=[],
+                        help='files to skip')
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help='the shard to translate')
+    parser.add_argument('--shard-count', type=int, default=1,
+                        help='the number of shards')
+    parser.add_argument('--manifest',
+                        help='write the outcomes to this json file')
+    parser.add_argument('--cache-dir',
+                        help='directory to cache tokenized files')
+    parser.add_argument('--merge', nargs='+', metavar='MANIFEST',
+                        help='merge manifests and check that they cover '
+                             'all files in dirname, instead of translating')
+    args = parser.parse_args(argv)
+    
+    if args.merge:
+        try:
+            outcomes = merge_manifests(args.merge, args.dirname)
+        except ValueError as err:
+            parser.exit(1, 'Error: %s\n' % err)
+        print('Merged %i manifests covering %i files.' %
+              (len(args.merge), len(outcomes)))
+    else:
+        LegacyPythonTranslator.translate_dir(args.dirname, args.skip,
+                                             args.shard_index,
+                                             args.shard_count,
+                                             args.manifest,
+                                             cache_dir=args.cache_dir)
+
+
+if __name__ == '__main__':
+    main()